@@ -1,91 +1,783 @@
 import os
+import sys
 import time
 import threading
+import queue
 import pickle
 import socket
+import hashlib
+import io
+import shutil
+import urllib.request
+from collections import OrderedDict
+
+# Native threads per inference. Each photo worker runs its own detector and
+# VGG-Face pass, so the pool gets cpu_count // INFERENCE_THREADS workers
+# (inner x outer = cores). Must be set before NumPy/OpenCV/TF load.
+INFERENCE_THREADS = 2
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+             "TF_NUM_INTRAOP_THREADS"):
+    os.environ.setdefault(_var, str(INFERENCE_THREADS))
+
+import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, render_template, send_from_directory
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+
+# TensorFlow reads this when DeepFace imports it, so it must be set first.
+# Defaults to the first GPU; set CUDA_VISIBLE_DEVICES="" to force CPU.
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
 from deepface import DeepFace
-from scipy.spatial.distance import cosine
+
+# FAISS is optional: without it we fall back to the brute-force matmul scan
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Numba is optional: it JIT-compiles the brute-force scan kernel
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# ONNX Runtime is optional: without it VGG-Face runs through Keras/TF
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# pillow-heif is optional: only needed for iPhone HEIC/HEIF photos
+try:
+    import pillow_heif
+except ImportError:
+    pillow_heif = None
+
+# waitress is optional: a multi-threaded production server for the photos,
+# used instead of Flask's development server when installed
+try:
+    from waitress import serve
+except ImportError:
+    serve = None
 
 # --- CONFIGURATION ---
 INPUT_FOLDER = 'incoming_photos'
-DB_FILE = 'database.pkl'
+EMB_FILE = 'embeddings.npy'
+SCALES_FILE = 'scales.npy'
+PATHS_FILE = 'paths.txt'
+# Pre-mmap database format, imported once if found
+LEGACY_DB_FILE = 'database.pkl'
+
+# HNSW graph settings: neighbours per node, and how many candidates the first
+# search asks for (doubled until every face under the threshold is returned)
+HNSW_NEIGHBORS = 32
+SEARCH_K = 200
+
+# Faces closer than this are logged; matches use the thresholds below
+LOG_THRESHOLD = 0.6
+
+# Rows dequantized per BLAS call in the brute-force scan (keeps the float32
+# working copy of a block cache-sized instead of copying the whole matrix)
+SCAN_BLOCK = 1024
 
 # VGG-Face is the "AK-47" of Face Recognition. 
 # It works in bad lighting, side angles, and groups.
 MODEL_NAME = "VGG-Face" 
+FACE_SIZE = 224
+
+# Faces per VGG-Face forward pass during the startup rescan
+EMBED_BATCH = 32
+
+# Run VGG-Face as an INT8 ONNX model on CPU (exported once from the Keras
+# weights). None = only when TensorFlow sees no GPU; True/False to force.
+USE_ONNX = None
+ONNX_MODEL = 'vgg_face.onnx'
+ONNX_INT8_MODEL = 'vgg_face_int8.onnx'
+
+# YuNet face detector (OpenCV >= 4.8), downloaded on first run. Falls back
+# to the Haar cascade if it can't be loaded.
+YUNET_MODEL = 'face_detection_yunet_2023mar.onnx'
+YUNET_URL = ('https://github.com/opencv/opencv_zoo/raw/main/models/'
+             'face_detection_yunet/' + YUNET_MODEL)
+YUNET_SCORE = 0.6
+# Seconds without data before the download gives up (captive portals etc.)
+YUNET_TIMEOUT = 20
+
+# Detection runs on a copy no larger than this (long side, px); faces are
+# still cropped from the full-resolution photo
+DETECT_MAX_SIDE = 1600
+
+# Selfie embeddings remembered by upload content hash, so a guest retrying
+# the same selfie skips detection and the VGG-Face pass
+SELFIE_CACHE_SIZE = 128
+
+# Photos never change once uploaded, so browsers may cache them for a year;
+# a retry then costs a 304 (or nothing) instead of re-sending the HD file
+PHOTO_MAX_AGE = 31536000
+SERVER_THREADS = 16
+
+# THRESHOLD FOR VGG-Face
+# 0.40 is the industry standard for VGG-Face (FAISS searches float vectors);
+# the int8 scan nudges it up to absorb the quantization error
+MATCH_THRESHOLD = 0.40
+INT8_MATCH_THRESHOLD = 0.42
+
+cv2.setNumThreads(INFERENCE_THREADS)
 
 app = Flask(__name__)
 
 # --- DATABASE SYSTEM ---
-face_database = []
+# Stored column-wise: a memory-mapped int8 (capacity, D) matrix with one
+# quantized L2-normalized row per face, its float32 scale in _scales, and the
+# photo path of each row in _paths (row ~= _emb_matrix[i] * _scales[i]).
+# Rows past len(_paths) are spare capacity, doubled (like a C++ vector) when
+# full, so inserts stay amortized O(1) and search reads the matrix in place.
+_emb_matrix = None
+_scales = None
+_paths = []
+# paths.txt is append-only between full saves: one line per inserted row
+_paths_fp = None
+_db_lock = threading.RLock()
+
+# ANN index over the same rows (ids == positions in _paths). Created on the
+# first insert, once the embedding dimension is known.
+_ann_index = None
+
+def _normalize(vector):
+    v = np.asarray(vector, dtype=np.float32)
+    return v / np.linalg.norm(v)
+
+def _new_ann_index(dim):
+    # Inner product on unit vectors == cosine similarity
+    return faiss.IndexHNSWFlat(dim, HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT)
+
+def _quantize(v):
+    # Symmetric per-vector int8: 4x smaller than float32, one scale per row
+    scale = float(np.abs(v).max()) / 127 or 1.0
+    return np.round(v / scale).astype(np.int8), scale
+
+def _close_map(m):
+    # Windows can't replace a file while a mapping of it is still open, so
+    # unmap explicitly rather than waiting for the GC
+    mm = getattr(m, '_mmap', None)
+    if mm is not None:
+        mm.close()
+
+def _grow_file(path, old, shape, dtype):
+    # Copy into a bigger file, then swap it in place of the old one
+    tmp_file = path + '.grow'
+    grown = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=shape)
+    n = len(_paths)
+    if n:
+        grown[:n] = old[:n]
+    grown.flush()
+    _close_map(grown)
+    _close_map(old)
+    del grown, old
+    os.replace(tmp_file, path)
+    return np.lib.format.open_memmap(path, mode='r+')
+
+def _grow_storage(capacity, dim):
+    global _emb_matrix, _scales
+    old_emb, old_scales = _emb_matrix, _scales
+    _emb_matrix = _scales = None
+    _emb_matrix = _grow_file(EMB_FILE, old_emb, (capacity, dim), np.int8)
+    del old_emb
+    _scales = _grow_file(SCALES_FILE, old_scales, (capacity,), np.float32)
+
+def add_to_index(path, embedding, update_ann=True):
+    # Embeddings are stored pre-normalized, so no norm work here
+    global _ann_index
+    v = np.asarray(embedding, dtype=np.float32)
+    q, scale = _quantize(v)
+    with _db_lock:
+        n = len(_paths)
+        if _emb_matrix is None or _emb_matrix.shape[1] != v.shape[0]:
+            _grow_storage(16, v.shape[0])
+        elif n == _emb_matrix.shape[0]:
+            _grow_storage(2 * n, v.shape[0])
+        _emb_matrix[n] = q
+        _scales[n] = scale
+        _paths.append(path)
+        _append_path(path)
+        if faiss is not None and update_ann:
+            if _ann_index is None:
+                _ann_index = _new_ann_index(v.shape[0])
+            _ann_index.add(np.ascontiguousarray(v[None]))
+
+def _append_path(path):
+    global _paths_fp
+    if _paths_fp is None:
+        _paths_fp = open(PATHS_FILE, 'a', encoding='utf-8')
+    _paths_fp.write(path + '\n')
+
+def _reset_paths_file():
+    global _paths_fp
+    if _paths_fp is not None:
+        _paths_fp.close()
+    _paths_fp = open(PATHS_FILE, 'w', encoding='utf-8')
+
+def clear_database():
+    # Keeps the mapped file as spare capacity; rows are overwritten on insert
+    global _paths, _ann_index
+    with _db_lock:
+        _paths = []
+        _ann_index = None
+        _reset_paths_file()
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _scan_kernel(emb, scales, targets):
+        # Best similarity per stored row over all targets, straight off the
+        # int8 rows (no dequantized copy), rows spread across cores
+        n, d = emb.shape
+        out = np.empty(n, np.float32)
+        for i in prange(n):
+            best = np.float32(-np.inf)
+            for t in range(targets.shape[0]):
+                acc = np.float32(0.0)
+                for j in range(d):
+                    acc += emb[i, j] * targets[t, j]
+                if acc > best:
+                    best = acc
+            out[i] = best * scales[i]
+        return out
+
+def warm_up_scan_kernel():
+    # Compile the kernel once at startup, outside _db_lock, so the first
+    # selfie search doesn't stall every photo worker behind the JIT
+    if njit is not None and faiss is None:
+        _scan_kernel(np.zeros((1, 1), np.int8), np.ones(1, np.float32), np.zeros((1, 1), np.float32))
+
+def search_index(target_vectors):
+    # Scores every stored face against all selfie faces (k, D) in one call.
+    # Returns the (path, best cosine distance) pairs under the log threshold,
+    # and the match threshold that fits the vectors the scores came from.
+    # Lower score = Better match (0.0 is identical, 1.0 is opposite)
+    targets = np.ascontiguousarray(target_vectors, dtype=np.float32)
+    with _db_lock:
+        paths = list(_paths)
+        if not paths:
+            return [], MATCH_THRESHOLD
+        if _ann_index is not None:
+            threshold = MATCH_THRESHOLD
+            # The couple can be in hundreds of photos: keep doubling k while
+            # the k-th hit of any selfie face is still under the threshold
+            k = min(SEARCH_K, len(paths))
+            while True:
+                # Per-query efSearch: the shared graph keeps its default
+                params = faiss.SearchParametersHNSW(efSearch=max(_ann_index.hnsw.efSearch, k))
+                sims, ids = _ann_index.search(targets, k, params=params)
+                if k >= len(paths) or (1.0 - sims[:, -1]).min() >= LOG_THRESHOLD:
+                    break
+                k = min(2 * k, len(paths))
+            sims, ids = sims.ravel(), ids.ravel()
+            keep = ids >= 0
+            best = {}
+            for i, sim in zip(ids[keep], sims[keep]):
+                best[i] = max(best.get(i, -1.0), sim)
+            ids = np.fromiter(best.keys(), dtype=np.int64, count=len(best))
+            scores = 1.0 - np.fromiter(best.values(), dtype=np.float32, count=len(best))
+        else:
+            # Rows are (approximately) unit vectors, so cosine distance = 1 - dot
+            threshold = INT8_MATCH_THRESHOLD
+            n = len(paths)
+            if njit is not None:
+                # Compiled by warm_up_scan_kernel() and cached on disk
+                sims = _scan_kernel(np.asarray(_emb_matrix[:n]), np.asarray(_scales[:n]), targets)
+            else:
+                sims = np.empty(n, dtype=np.float32)
+                for start in range(0, n, SCAN_BLOCK):
+                    stop = min(start + SCAN_BLOCK, n)
+                    block = _emb_matrix[start:stop].astype(np.float32)
+                    sims[start:stop] = (block @ targets.T).max(axis=1) * _scales[start:stop]
+            scores = 1.0 - sims
+            ids = np.arange(n)
+    close = scores < LOG_THRESHOLD
+    return [(paths[i], float(score)) for i, score in zip(ids[close], scores[close])], threshold
+
+def _migrate_pickle():
+    # One-off import of the old list-of-dicts pickle
+    with open(LEGACY_DB_FILE, 'rb') as f:
+        legacy = pickle.load(f)
+    _reset_paths_file()
+    for entry in legacy:
+        # Older pickles stored raw (un-normalized) vectors
+        v = np.asarray(entry['embedding'], dtype=np.float32)
+        if not np.isclose(np.linalg.norm(v), 1.0, atol=1e-3):
+            v = _normalize(v)
+        add_to_index(entry['path'], v, update_ann=False)
+    save_database()
+
+def _migrate_float_matrix():
+    # One-off quantization of a float32 embeddings.npy from before int8 storage
+    global _emb_matrix, _scales, _paths
+    rows, paths = np.array(_emb_matrix[:len(_paths)]), _paths
+    _close_map(_emb_matrix)
+    _close_map(_scales)
+    _emb_matrix, _scales, _paths = None, None, []
+    _reset_paths_file()
+    for path, v in zip(paths, rows):
+        add_to_index(path, v, update_ann=False)
+    save_database()
 
 def load_database():
-    global face_database
-    if os.path.exists(DB_FILE):
+    # Only the rows are loaded. The FAISS graph lives in memory and is built
+    # as faces are inserted by the startup rescan; until then searches use
+    # the exact scan.
+    global _emb_matrix, _scales, _paths
+    with _db_lock:
         try:
-            with open(DB_FILE, 'rb') as f:
-                face_database = pickle.load(f)
-            print(f"[SYSTEM] Loaded {len(face_database)} photos from memory.")
+            if os.path.exists(EMB_FILE) and os.path.exists(PATHS_FILE):
+                _emb_matrix = np.lib.format.open_memmap(EMB_FILE, mode='r+')
+                with open(PATHS_FILE, encoding='utf-8') as f:
+                    _paths = f.read().splitlines()[:_emb_matrix.shape[0]]
+                if _emb_matrix.dtype == np.int8 and os.path.exists(SCALES_FILE):
+                    _scales = np.lib.format.open_memmap(SCALES_FILE, mode='r+')
+                else:
+                    _migrate_float_matrix()
+            elif os.path.exists(LEGACY_DB_FILE):
+                _migrate_pickle()
+            print(f"[SYSTEM] Loaded {len(_paths)} photos from memory.")
         except:
-            face_database = []
+            _emb_matrix, _scales, _paths = None, None, []
+
+def flush_database():
+    # Per-insert persistence: the new rows already live in the mapped files
+    # and paths.txt only got appended to, so nothing is rewritten
+    with _db_lock:
+        if _emb_matrix is not None:
+            _emb_matrix.flush()
+            _scales.flush()
+        if _paths_fp is not None:
+            _paths_fp.flush()
 
 def save_database():
-    with open(DB_FILE, 'wb') as f:
-        pickle.dump(face_database, f)
+    # Full save after bulk loads: rewrites paths.txt
+    with _db_lock:
+        if _emb_matrix is not None:
+            _emb_matrix.flush()
+            _scales.flush()
+        _reset_paths_file()
+        _paths_fp.writelines(p + '\n' for p in _paths)
+        _paths_fp.flush()
 
 # --- AI ENGINE ---
-def generate_embedding(img_path):
+# Built once and reused, so each photo skips DeepFace.represent's per-call
+# model lookup, detector setup and input validation.
+_vgg = None
+_onnx_sess = None
+_use_yunet = False
+_face_cascade = None
+_model_lock = threading.Lock()
+# YuNet keeps per-call input size state, so each worker thread gets its own
+# detector instead of all photos queueing on one
+_yunet_local = threading.local()
+
+# 5-point landmark template (eyes, nose, mouth corners) from ArcFace's
+# 112x112 crop, scaled to the VGG-Face input size
+_ALIGN_SRC = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041],
+], dtype=np.float32) * (FACE_SIZE / 112)
+
+def _build_onnx_session(keras_model):
+    if not os.path.exists(ONNX_INT8_MODEL):
+        if not os.path.exists(ONNX_MODEL):
+            import tensorflow as tf
+            import tf2onnx
+            print("[SYSTEM] Exporting VGG-Face to ONNX (First Run Only)...")
+            spec = (tf.TensorSpec((None, FACE_SIZE, FACE_SIZE, 3), tf.float32, name='input'),)
+            tf2onnx.convert.from_keras(keras_model, input_signature=spec, output_path=ONNX_MODEL)
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        # Only the fully-connected layers (most of VGG's weights): quantized
+        # convs become ConvInteger, which some ORT CPU builds can't run
+        quantize_dynamic(ONNX_MODEL, ONNX_INT8_MODEL, weight_type=QuantType.QInt8,
+                         op_types_to_quantize=['MatMul', 'Gemm'])
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = INFERENCE_THREADS
+    sess = ort.InferenceSession(ONNX_INT8_MODEL, options, providers=['CPUExecutionProvider'])
+    # Fail here, not on the first photo, if the build can't run the graph
+    name = sess.get_inputs()[0].name
+    sess.run(None, {name: np.zeros((1, FACE_SIZE, FACE_SIZE, 3), dtype=np.float32)})
+    return sess
+
+def _tf_gpus():
     try:
+        import tensorflow as tf
+        return tf.config.list_physical_devices('GPU')
+    except Exception:
+        return []
+
+def _download_yunet():
+    # Written to a temp file and only moved into place once OpenCV can load
+    # it, so a cut-off download or a captive-portal HTML page never sticks
+    print("[SYSTEM] Downloading YuNet face detector (First Run Only)...")
+    tmp_file = YUNET_MODEL + '.part'
+    try:
+        with urllib.request.urlopen(YUNET_URL, timeout=YUNET_TIMEOUT) as r, open(tmp_file, 'wb') as f:
+            shutil.copyfileobj(r, f)
+        cv2.FaceDetectorYN.create(tmp_file, '', (320, 320), YUNET_SCORE)
+        os.replace(tmp_file, YUNET_MODEL)
+    finally:
+        if os.path.exists(tmp_file): os.remove(tmp_file)
+
+def _build_yunet():
+    # This thread's detector, created on first use
+    detector = getattr(_yunet_local, 'detector', None)
+    if detector is None:
+        if not os.path.exists(YUNET_MODEL):
+            _download_yunet()
+        detector = cv2.FaceDetectorYN.create(YUNET_MODEL, '', (320, 320), YUNET_SCORE)
+        _yunet_local.detector = detector
+    return detector
+
+def get_models():
+    global _vgg, _onnx_sess, _use_yunet, _face_cascade
+    with _model_lock:
+        if _vgg is None:
+            model = DeepFace.build_model(MODEL_NAME)
+            # Newer DeepFace wraps the Keras model in a client object
+            _vgg = getattr(model, 'model', model)
+            _face_cascade = cv2.CascadeClassifier(
+                cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+            )
+            try:
+                _build_yunet()
+                _use_yunet = True
+            except Exception as e:
+                print(f"[AI WARNING] YuNet unavailable, using Haar cascade: {e}")
+            use_onnx = USE_ONNX if USE_ONNX is not None else not _tf_gpus()
+            if use_onnx and ort is not None:
+                try: _onnx_sess = _build_onnx_session(_vgg)
+                except Exception as e:
+                    print(f"[AI WARNING] ONNX model unusable, using Keras: {e}")
+    return _vgg, _face_cascade
+
+def report_accelerator():
+    if _onnx_sess is not None:
+        print("[SYSTEM] VGG-Face running on CPU (ONNX Runtime, INT8)")
+        return
+    gpus = _tf_gpus()
+    if gpus:
+        print(f"[SYSTEM] VGG-Face running on GPU ({', '.join(g.name for g in gpus)})")
+    else:
+        print("[SYSTEM] VGG-Face running on CPU (no CUDA GPU visible to TensorFlow)")
+
+def _resize_pad(face):
+    # Fit inside FACE_SIZE x FACE_SIZE keeping aspect ratio, pad with black
+    h, w = face.shape[:2]
+    scale = FACE_SIZE / max(h, w)
+    face = cv2.resize(face, (max(1, int(w * scale)), max(1, int(h * scale))))
+    out = np.zeros((FACE_SIZE, FACE_SIZE, 3), dtype=np.uint8)
+    y, x = (FACE_SIZE - face.shape[0]) // 2, (FACE_SIZE - face.shape[1]) // 2
+    out[y:y + face.shape[0], x:x + face.shape[1]] = face
+    return out
+
+def _estimate_norm_fast(landmarks):
+    # Similarity transform onto the template; much cheaper than lstsq
+    M, _ = cv2.estimateAffinePartial2D(landmarks, _ALIGN_SRC, method=cv2.LMEDS)
+    return M
+
+def _align(rgb, face):
+    # face is a YuNet row: x, y, w, h, 5 (x, y) landmarks, score
+    M = _estimate_norm_fast(face[4:14].reshape(5, 2))
+    if M is None:
+        x, y, w, h = np.maximum(face[:4], 0).astype(int)
+        return _resize_pad(rgb[y:y + h, x:x + w])
+    return cv2.warpAffine(rgb, M, (FACE_SIZE, FACE_SIZE), borderValue=0)
+
+def _load_heif(fp):
+    # OpenCV can't read HEIC/HEIF; sniffed by content, not file extension
+    if pillow_heif is None or not pillow_heif.is_supported(fp):
+        return None
+    if hasattr(fp, 'seek'): fp.seek(0)
+    heif = pillow_heif.open_heif(fp, convert_hdr_to_8bit=True)
+    return np.ascontiguousarray(np.asarray(heif)[:, :, :3])
+
+def load_rgb(path):
+    # Decode straight into a NumPy array (libjpeg-turbo/libpng via OpenCV)
+    im = cv2.imread(path, cv2.IMREAD_COLOR)
+    if im is not None:
+        return cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+    return _load_heif(path)
+
+def decode_rgb(data):
+    # Same as load_rgb, for an in-memory upload (never touches the disk)
+    im = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if im is not None:
+        return cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+    return _load_heif(io.BytesIO(data))
+
+def detect_faces(image, enforce_detection=True):
+    # image is a file path or the raw bytes of an upload.
+    # Returns a (k, FACE_SIZE, FACE_SIZE, 3) uint8 RGB stack, or None
+    get_models()
+    rgb = decode_rgb(image) if isinstance(image, bytes) else load_rgb(image)
+    if rgb is None:
+        raise ValueError("unreadable image")
+
+    h, w = rgb.shape[:2]
+    scale = min(1.0, DETECT_MAX_SIDE / max(h, w))
+    small = rgb if scale == 1.0 else cv2.resize(rgb, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    if _use_yunet:
+        # YuNet gives 5-point landmarks, so faces are aligned, not just cropped
+        bgr = cv2.cvtColor(small, cv2.COLOR_RGB2BGR)
+        yunet = _build_yunet()
+        yunet.setInputSize((bgr.shape[1], bgr.shape[0]))
+        _, faces = yunet.detect(bgr)
+        if faces is not None and len(faces):
+            faces[:, :14] /= scale
+            return np.stack([_align(rgb, face) for face in faces])
+    else:
+        # Detect with OpenCV Haar (same backend DeepFace's "opencv" uses)
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+        boxes = _face_cascade.detectMultiScale(gray, 1.1, 10)
+        if len(boxes):
+            boxes = (np.asarray(boxes) / scale).astype(int)
+            return np.stack([_resize_pad(rgb[y:y + h, x:x + w]) for x, y, w, h in boxes])
+
+    if enforce_detection:
+        return None
+    # Loose mode (selfies): fall back to the whole frame
+    return _resize_pad(rgb)[None]
+
+def embed_many(crops):
+    # One VGG-Face forward pass per EMBED_BATCH faces instead of per photo
+    vgg, _ = get_models()
+    # Crops are RGB; VGG-Face is a Caffe-trained BGR network and
+    # DeepFace.represent fed it BGR, which the thresholds were tuned on
+    x = np.asarray(crops, dtype=np.float32)[..., ::-1] / 255.0
+    if _onnx_sess is not None:
+        name = _onnx_sess.get_inputs()[0].name
+        return np.concatenate([
+            _onnx_sess.run(None, {name: x[i:i + EMBED_BATCH]})[0]
+            for i in range(0, len(x), EMBED_BATCH)
+        ])
+    return vgg.predict(x, batch_size=EMBED_BATCH, verbose=0)
+
+def generate_embedding(image, enforce_detection=True):
+    try:
+        crops = detect_faces(image, enforce_detection)
+        if crops is None:
+            return None
         # Generate Vector using VGG-Face
-        results = DeepFace.represent(
-            img_path=img_path, 
-            model_name=MODEL_NAME, 
-            enforce_detection=True, 
-            detector_backend="opencv"
-        )
-        return results
+        return [{'embedding': e} for e in embed_many(crops)]
     except ValueError:
         return None
     except Exception as e:
-        print(f"[AI WARNING] Could not process {img_path}: {e}")
+        label = "selfie" if isinstance(image, bytes) else image
+        print(f"[AI WARNING] Could not process {label}: {e}")
         return None
 
+def _is_photo(filename):
+    return not (filename.startswith('.') or filename.endswith('.tmp'))
+
+def add_faces(filename, embeddings):
+    for e in embeddings:
+        # L2-normalize once at insertion; cosine is then just 1 - dot
+        embedding = _normalize(e)
+        add_to_index(filename, embedding)
+
+def wait_until_stable(path, interval=0.05, timeout=30.0, empty_timeout=2.0):
+    # A file is done copying once two reads of its size agree and it opens.
+    # Gives up (False) on files that stay empty or never settle, so one
+    # placeholder can't hold a worker forever.
+    start = time.monotonic()
+    last = -1
+    while True:
+        try: size = os.path.getsize(path)
+        except OSError: return False
+        if size == last and size > 0:
+            try:
+                with open(path, 'rb'): return True
+            except OSError: pass
+        elapsed = time.monotonic() - start
+        if elapsed > timeout or (size == 0 and elapsed > empty_timeout):
+            print(f"[SKIPPED] {os.path.basename(path)} is empty or still being written")
+            return False
+        last = size
+        time.sleep(interval)
+
+# Version (size, mtime) of each file last picked up, so the created and
+# close-write events of one copy don't index the same photo twice
+_seen = {}
+_seen_lock = threading.Lock()
+
+def _claim(filename, file_path):
+    try: st = os.stat(file_path)
+    except OSError: return False
+    version = (st.st_size, st.st_mtime_ns)
+    with _seen_lock:
+        if _seen.get(filename) == version: return False
+        _seen[filename] = version
+    return True
+
 def process_file(filename):
-    if filename.startswith('.') or filename.endswith('.tmp'): return
+    if not _is_photo(filename): return
     file_path = os.path.join(INPUT_FOLDER, filename)
-    time.sleep(1)
+    if not wait_until_stable(file_path): return
+    if not _claim(filename, file_path): return
 
     print(f"[PROCESSING] {filename}...")
     results = generate_embedding(file_path)
     
     if results:
-        count = 0
-        for face in results:
-            face_database.append({
-                'path': filename,
-                'embedding': face['embedding']
-            })
-            count += 1
-        save_database()
-        print(f"[SUCCESS] Added {filename} ({count} faces found)")
+        add_faces(filename, [face['embedding'] for face in results])
+        flush_database()
+        print(f"[SUCCESS] Added {filename} ({len(results)} faces found)")
     else:
         print(f"[SKIPPED] No face found: {filename}")
 
+def _detect_for_scan(filename):
+    print(f"[PROCESSING] {filename}...")
+    try:
+        return detect_faces(os.path.join(INPUT_FOLDER, filename))
+    except ValueError:
+        return None
+    except Exception as e:
+        print(f"[AI WARNING] Could not process {filename}: {e}")
+        return None
+
+def _embed_for_scan(batch):
+    return batch, embed_many(np.stack([crop for crop, _ in batch]))
+
+def scan_existing_files():
+    # Pass 1 detects faces file by file; pass 2 embeds the buffered crops
+    # EMBED_BATCH at a time so VGG-Face never runs at batch size 1. Both run
+    # on the photo pool: each inference is capped at INFERENCE_THREADS, so
+    # the rescan needs the pool's workers to use every core.
+    pool = get_pool()
+    files = [f for f in sorted(os.listdir(INPUT_FOLDER)) if _is_photo(f)]
+    pending = []  # (crop, filename)
+    batches = []
+
+    for filename, crops in zip(files, pool.map(_detect_for_scan, files)):
+        if crops is None:
+            print(f"[SKIPPED] No face found: {filename}")
+            continue
+        pending.extend((crop, filename) for crop in crops)
+        if len(pending) >= EMBED_BATCH:
+            batches.append(pool.submit(_embed_for_scan, pending))
+            pending = []
+    if pending:
+        batches.append(pool.submit(_embed_for_scan, pending))
+
+    # Added in submission order, so row order matches the sorted file list
+    for job in batches:
+        batch, embeddings = job.result()
+        per_file = {}
+        for (_, filename), e in zip(batch, embeddings):
+            per_file.setdefault(filename, []).append(e)
+        for filename, faces in per_file.items():
+            add_faces(filename, faces)
+            print(f"[SUCCESS] Added {filename} ({len(faces)} faces found)")
+    save_database()
+
 # --- FOLDER MONITORING ---
+# Watchdog events go into a bounded queue; a single dispatcher feeds them to
+# one persistent worker pool instead of spawning one thread per photo. The
+# dispatcher only submits when a worker is free, so a 500-photo dump waits
+# in the queue rather than piling up inside the executor. When the queue is
+# full the handler blocks, leaving the backlog in watchdog's own event queue,
+# so no photo is ever dropped.
+_photo_queue = queue.Queue(maxsize=256)
+_pool = None
+_pool_slots = None
+
+def dispatch_photos():
+    while True:
+        filename = _photo_queue.get()
+        _pool_slots.acquire()
+        future = _pool.submit(process_file, filename)
+        future.add_done_callback(lambda _: _pool_slots.release())
+
+def get_pool():
+    # One pool for the startup rescan and the watcher: outer workers x
+    # INFERENCE_THREADS native threads each = cores
+    global _pool, _pool_slots
+    if _pool is None:
+        workers = max(1, (os.cpu_count() or 1) // INFERENCE_THREADS)
+        _pool = ThreadPoolExecutor(max_workers=workers)
+        _pool_slots = threading.BoundedSemaphore(workers)
+    return _pool
+
+def start_monitoring():
+    get_pool()
+    threading.Thread(target=dispatch_photos, daemon=True).start()
+
+    observer, close_events = _new_observer()
+    observer.schedule(NewPhotoHandler(close_events), path=INPUT_FOLDER, recursive=False)
+    observer.start()
+    return observer
+
+def _new_observer():
+    # On Linux, inotify reports IN_CLOSE_WRITE as on_closed, the moment a copy
+    # is complete. With full events, a file moved in from outside the folder
+    # arrives as a move (empty src) rather than a plain create, so created
+    # events can be ignored there.
+    if sys.platform.startswith('linux') and hasattr(FileSystemEventHandler, 'on_closed'):
+        try: return Observer(generate_full_events=True), True
+        except TypeError: pass  # watchdog too old for full events
+    return Observer(), False
+
 class NewPhotoHandler(FileSystemEventHandler):
+    def __init__(self, close_events):
+        super().__init__()
+        self.close_events = close_events
+
     def on_created(self, event):
-        if not event.is_directory:
-            filename = os.path.basename(event.src_path)
-            threading.Thread(target=process_file, args=(filename,)).start()
+        # Without close-write, the size poll in process_file decides when the
+        # copy is done. With it, a create is only the start of a write.
+        if not self.close_events:
+            self.enqueue(event.src_path, event.is_directory)
+
+    def on_closed(self, event):
+        self.enqueue(event.src_path, event.is_directory)
+
+    def on_moved(self, event):
+        # Moved in from elsewhere, or a sync tool renaming its temp file
+        if event.dest_path and os.path.dirname(os.path.abspath(event.dest_path)) == os.path.abspath(INPUT_FOLDER):
+            self.enqueue(event.dest_path, event.is_directory)
+
+    def enqueue(self, path, is_directory):
+        if not is_directory:
+            _photo_queue.put(os.path.basename(path))
 
 # --- WEB SERVER ---
+_selfie_cache = OrderedDict()  # sha256 -> generate_embedding() result
+_selfie_cache_lock = threading.Lock()
+
+def embed_selfie(data):
+    key = hashlib.sha256(data).hexdigest()
+    with _selfie_cache_lock:
+        if key in _selfie_cache:
+            print("[CACHE] Same selfie as before, reusing its faces.")
+            return _selfie_cache[key]
+
+    # Decoded in memory, so concurrent uploads can't overwrite each other.
+    # Allow loose detection for selfies
+    results = generate_embedding(data, enforce_detection=False)
+
+    # None may be a transient failure; let the guest's retry run again
+    if results is None:
+        return None
+    with _selfie_cache_lock:
+        _selfie_cache[key] = results
+        # FIFO eviction once full
+        while len(_selfie_cache) > SELFIE_CACHE_SIZE:
+            _selfie_cache.popitem(last=False)
+    return results
+
 @app.route('/', methods=['GET', 'POST'])
 def home():
-    matches = []
+    matches = set()
     is_search = False
 
     if request.method == 'POST':
@@ -97,64 +789,61 @@ def home():
             print("📸 NEW SELFIE UPLOADED")
             print("="*30)
             
-            temp_path = "temp_selfie.jpg"
-            file.save(temp_path)
-            
             try:
-                # 1. Get Selfie Vector (Allow loose detection for selfies)
-                selfie_results = DeepFace.represent(
-                    temp_path, 
-                    model_name=MODEL_NAME, 
-                    enforce_detection=False,
-                    detector_backend="opencv"
-                )
+                # 1. Get Selfie Vector (cached by content for retries)
+                selfie_results = embed_selfie(file.read())
                 
                 if selfie_results:
                     # Check every face found in the selfie (usually just 1)
-                    for selfie_face in selfie_results:
-                        target_vector = selfie_face['embedding']
-                        
-                        # Compare against EVERY photo in DB
-                        for entry in face_database:
-                            db_vector = entry['embedding']
-                            
-                            # SCIPY CALCULATION (Accurate Math)
-                            # Lower score = Better match (0.0 is identical, 1.0 is opposite)
-                            score = cosine(target_vector, db_vector)
-                            
-                            # LOGGING: See exactly what's happening
-                            # Only print if it's somewhat close to reduce spam
-                            if score < 0.6: 
-                                print(f"Checking {entry['path']}... Score: {round(score, 3)}")
-                            
-                            # THRESHOLD FOR VGG-Face
-                            # 0.40 is the industry standard for VGG-Face
-                            if score < 0.40:
-                                print(f"✅ MATCH FOUND! ({entry['path']})")
-                                matches.append(entry['path'])
-                    
-                    matches = list(set(matches))
+                    targets = np.stack([_normalize(face['embedding']) for face in selfie_results])
+
+                    # Compare against EVERY photo in DB in a single call (ANN
+                    # graph walk when FAISS is available, one matmul otherwise)
+                    hits, threshold = search_index(targets)
+                    for path, score in hits:
+                        # Another face in this photo already matched
+                        if path in matches: continue
+
+                        # LOGGING: See exactly what's happening
+                        # Only print if it's somewhat close to reduce spam
+                        print(f"Checking {path}... Score: {round(score, 3)}")
+
+                        if score < threshold:
+                            print(f"✅ MATCH FOUND! ({path})")
+                            matches.add(path)
+
                     print(f"[RESULT] Returning {len(matches)} photos.")
                 else:
                     print("[RESULT] No faces detected in selfie.")
 
             except Exception as e:
                 print(f"Selfie Error: {e}")
-            
-            if os.path.exists(temp_path): os.remove(temp_path)
 
-    return render_template('index.html', photos=matches, searched=is_search)
+    return render_template('index.html', photos=list(matches), searched=is_search)
 
 @app.route('/photos/<path:filename>')
 def serve_hd(filename):
-    return send_from_directory(INPUT_FOLDER, filename)
+    # Flask already answers conditionally (ETag/If-Modified-Since, Range);
+    # max_age lets browsers skip even the revalidation
+    return send_from_directory(INPUT_FOLDER, filename, max_age=PHOTO_MAX_AGE)
 
 # --- STARTUP ---
 def get_ip():
+    # connect() on a UDP socket only picks the outgoing interface from the
+    # routing table: no packets are sent and no DNS lookup happens
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        return s.getsockname()[0]
+        try:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+        finally:
+            s.close()
+    except OSError:
+        pass
+    # No default route (offline hotspot): fall back to the hostname's addresses
+    try:
+        infos = socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)
+        return next((a[4][0] for a in infos if not a[4][0].startswith('127.')), "127.0.0.1")
     except: return "127.0.0.1"
 
 if __name__ == '__main__':
@@ -164,21 +853,20 @@ if __name__ == '__main__':
     print("--------------------------------------------------")
     print("🚀 DOWNLOADING VGG-FACE MODEL (First Run Only)...")
     print("--------------------------------------------------")
-    try: DeepFace.build_model(MODEL_NAME)
+    try: get_models()
     except: pass
+    report_accelerator()
+    warm_up_scan_kernel()
 
     load_database()
     
     # Re-scan clean
     print("[SYSTEM] Scanning existing files...")
     # NOTE: We clear the RAM database on startup to ensure we don't have old ghosts
-    face_database = [] 
-    for f in os.listdir(INPUT_FOLDER):
-        process_file(f)
+    clear_database()
+    scan_existing_files()
 
-    observer = Observer()
-    observer.schedule(NewPhotoHandler(), path=INPUT_FOLDER, recursive=False)
-    observer.start()
+    observer = start_monitoring()
 
     ip = get_ip()
     print("\n" + "="*40)
@@ -186,4 +874,7 @@ if __name__ == '__main__':
     print(f"🔗 URL: http://{ip}:5000")
     print("="*40 + "\n")
 
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    if serve is not None:
+        serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS)
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file